@@ -2,13 +2,17 @@
 This module will will generate HTML reports for the views in a sqlite database.
 """
 
-import copy
 import json
 import os
+import re
 import sqlite3 as sq3
 from datetime import datetime
 
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+
+# Databases smaller than this many pages are read quickly enough that copying
+# their views into memory costs more than it saves.
+MATERIALIZE_MIN_PAGES = 64
 
 
 class Report:
@@ -32,17 +36,40 @@ class Report:
         if not os.path.exists(self.paths["database"]):
             msg = f"database '{self.paths['database']}' does not exist"
             raise FileNotFoundError(msg)
-        self.cursor = sq3.connect(self.paths["database"]).cursor()
+        self.__connection = sq3.connect(self.paths["database"])
+        self.cursor = self.__connection.cursor()
+        self.__set_pragmas(self.layout["pragmas"])
+        if self.layout["optimize_on_connect"]:
+            self.__optimize()
+        self.__columns = {}
         self.ignore = kwargs.get(
             "ignore_views", self.layout.get("ignore_views", [])
         )
+        # the queries are built once from the view names in the database, so
+        # only those views can ever be queried
+        self.__queries = {
+            view: f"SELECT * FROM {self.__quote(view)}"
+            for view in self.__get_views()
+        }
+        if self.layout["materialize_views"]:
+            self.__materialize_views(self.views)
+        self.__titles = {
+            view: self.layout["titles"].get(view, view)
+            for view in self.__get_views()
+        }
         self.categories = self.__get_categories()
         self.env = Environment(
             trim_blocks=True,
             lstrip_blocks=True,
+            auto_reload=False,
+            cache_size=-1,
             loader=FileSystemLoader(os.path.dirname(self.paths["template"])),
+            bytecode_cache=FileSystemBytecodeCache(),
         )
         self.env.filters["has_link"] = lambda value: isinstance(value, tuple)
+        self.__template = self.env.get_template(
+            os.path.basename(self.paths["template"])
+        )
 
     def __del__(self):
         """
@@ -50,6 +77,7 @@ class Report:
         """
         try:
             self.cursor.close()
+            self.__connection.close()
         except AttributeError:
             pass
 
@@ -88,6 +116,7 @@ class Report:
         if not isinstance(categories, dict):
             raise TypeError("categories must be a dict")
 
+        views = frozenset(self.views)
         for category, entries in categories.items():
             # first, check that all categories are strings, and all values
             # are lists
@@ -99,11 +128,14 @@ class Report:
             # check that all entries are actually a view. Otherwise it will
             # create a broken link (ie, a link that goes to a non-existent
             for entry in entries:
-                if entry not in self.views:
+                if entry not in views:
                     raise ValueError(
                         f"given category item '{entry}' does not have a report"
                     )
         self.__categories = categories
+        # the links only change with the categories, so they are built here
+        # rather than for every report
+        self.__category_links = self.__get_category_links(categories)
 
     @property
     def ignore(self):
@@ -126,13 +158,16 @@ class Report:
     @ignore.setter
     def ignore(self, values):
 
+        # make sure the views have been retrieved from the database
+        self.__get_views()
         for value in values:
-            if value not in self.__get_views():
+            if value not in self.__all_views_set:
                 raise ValueError(
                     f"Cannot update ignore list since '{value}' "
                     f"is not a view"
                 )
         self.__ignore = values
+        self.__ignore_set = frozenset(values)
 
     @property
     def paths(self):
@@ -142,6 +177,86 @@ class Report:
     def paths(self, paths):
         self.__paths = paths
 
+    def __set_pragmas(self, pragmas):
+        """
+        Tune the database connection with the pragmas given in the layout
+
+        A pragma with a value of :obj:`None` is not set, which leaves the
+        sqlite default in place.
+
+        Raises a :obj:`ValueError` when a pragma name is not a single word,
+        or its value is not a number, boolean, or single word.
+        """
+        for pragma, value in pragmas.items():
+            if value is None:
+                continue
+            if not isinstance(pragma, str) or not re.fullmatch(r"\w+", pragma):
+                raise ValueError(f"invalid pragma name '{pragma}'")
+            if isinstance(value, bool):
+                value = int(value)
+            elif not isinstance(value, (int, float)) and not (
+                isinstance(value, str) and re.fullmatch(r"\w+", value)
+            ):
+                msg = f"invalid value '{value}' for pragma '{pragma}'"
+                raise ValueError(msg)
+            self.cursor.execute(f"PRAGMA {pragma} = {value}")
+
+    def __optimize(self):
+        """
+        Gather the statistics the query planner uses to run the views
+
+        A full ``ANALYZE`` is run when the database has no statistics yet.
+        Otherwise ``PRAGMA optimize=0x10002`` re-analyzes any tables whose
+        statistics are out of date. sqlite versions before 3.46 ignore the
+        0x10000 flag, and only analyze tables already queried by this
+        connection, which is none when connecting.
+
+        Both may write to the database, so they are skipped when the database
+        is read-only.
+        """
+        sql = "SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'"
+        has_stats = self.cursor.execute(sql).fetchone() is not None
+        try:
+            if has_stats:
+                self.cursor.execute("PRAGMA optimize=0x10002")
+            else:
+                self.cursor.execute("ANALYZE")
+        except sq3.OperationalError:
+            pass
+
+    @staticmethod
+    def __quote(name):
+        """return the name quoted to be used as an identifier in a query"""
+        return '"{}"'.format(name.replace('"', '""'))
+
+    def __materialize_views(self, views):
+        """
+        Copy the results of each view into a table in an in-memory database
+
+        The views are queried once here, and every report rendered after this
+        reads the copied table instead of running the view's query again.
+        A view that fails to copy (for example, one that references a dropped
+        table) is left to be queried directly when its report is rendered.
+
+        Nothing is copied when the whole database is smaller than
+        `MATERIALIZE_MIN_PAGES`, the size of each view is not considered.
+        """
+        page_count = self.cursor.execute("PRAGMA page_count").fetchone()[0]
+        if page_count < MATERIALIZE_MIN_PAGES:
+            return
+
+        self.cursor.execute("ATTACH DATABASE ':memory:' AS cache")
+        for view in views:
+            name = self.__quote(view)
+            table = f"cache.{name}"
+            try:
+                self.cursor.execute(
+                    f"CREATE TABLE {table} AS SELECT * FROM main.{name}"
+                )
+            except sq3.OperationalError:
+                continue
+            self.__queries[view] = f"SELECT * FROM {table}"
+
     def __get_views(self):
         """
         Returns list of all views
@@ -165,6 +280,7 @@ class Report:
                  ORDER BY name"""
         data = self.cursor.execute(sql)
         self.__all_views = [view[0] for view in data]
+        self.__all_views_set = frozenset(self.__all_views)
         return self.__all_views
 
     @property
@@ -179,24 +295,29 @@ class Report:
         """
 
         # Filter out any views that are in the ignore list
-        return [v for v in self.__get_views() if v not in self.ignore]
+        return [v for v in self.__get_views() if v not in self.__ignore_set]
 
-    def __set_defaults(self, default_layout, user_layout):
+    @staticmethod
+    def __set_defaults(default_layout, user_layout):
         """
         Set the values in the user_layout to override the defaults
 
-        This will recursively navigate through the default layout dictionary
-        to ensure the user specified layout has all the required keys.
+        This will navigate through the nested default layout dictionaries to
+        ensure the user specified layout has all the required keys.
 
         :return: dict: user_layout
         :param default_layout: dict: default layout
         :param user_layout: dict: user layout (defaults to None)
         """
 
-        for k, v in default_layout.items():
-            user_layout.setdefault(k, v)
-            if isinstance(v, dict):
-                self.__set_defaults(v, user_layout[k])
+        # pairs of (default, user) dictionaries still to be merged
+        stack = [(default_layout, user_layout)]
+        while stack:
+            defaults, layout = stack.pop()
+            for k, v in defaults.items():
+                layout.setdefault(k, v)
+                if isinstance(v, dict):
+                    stack.append((v, layout[k]))
         return user_layout
 
     @staticmethod
@@ -231,14 +352,16 @@ class Report:
             full_path = os.path.abspath(os.path.join(base_path, *dirs))
 
             layout_paths.setdefault(key, full_path)
-            if os.path.isdir(full_path) and key != "report_dir":
-                files = []
-                for file in os.listdir(full_path):
-                    files.append(os.path.join(full_path, file))
-                if not files:
-                    layout_paths[key] = full_path
-                else:
-                    layout_paths[key] = files
+            if key == "report_dir":
+                continue
+            try:
+                with os.scandir(full_path) as entries:
+                    files = [entry.path for entry in entries]
+            except (FileNotFoundError, NotADirectoryError):
+                # path is a file, or does not exist yet
+                continue
+            if files:
+                layout_paths[key] = files
         return layout_paths
 
     def __get_layout(self, user_path, kwargs):
@@ -288,7 +411,7 @@ class Report:
         """
 
         # create copy of category parameter to avoid changing input
-        updated_categories = copy.deepcopy(categories)
+        updated_categories = {k: list(v) for k, v in categories.items()}
 
         # create list of all view names that are included with any category.
         # This will be a set, so any duplicates are removed
@@ -325,85 +448,130 @@ class Report:
     def __get_category_links(self, cat_list):
         categories = {}
         for key in cat_list:
-            paths = []
             titles = self.__get_title(cat_list[key])
-            for link in cat_list[key]:
-                # Note all the reports are all in the same folder
-                path = os.path.join(".", link + ".html")
-                paths.append(path)
+            # Note all the reports are all in the same folder
+            paths = [f"./{link}.html" for link in cat_list[key]]
             categories.setdefault(key, (titles, paths))
 
         return categories
 
-    def __get_data(self, views):
-        """get the data for the view(s) given"""
+    def __get_rows(self, view_name):
+        """
+        Return a cursor over all rows of the view given
 
-        if views is None:
-            # views are None, set to use all views
-            views = self.views
-        elif not isinstance(views, list):
-            # make the view a list
-            views = [views]
+        The rows are not fetched here. The cursor is iterated over while the
+        report is rendered, so rows are emitted as they are stepped from the
+        database rather than being loaded into memory all at once.
 
-        data = {}
-        for view in views:
-            sql = "SELECT * FROM '{}'".format(view)
-            results = self.cursor.execute(sql).fetchall()
-            data.setdefault(view, results)
-        return data
+        Raises a :obj:`ValueError` when the view is not in the database.
+        """
+        try:
+            sql = self.__queries[view_name]
+        except KeyError:
+            raise ValueError(f"'{view_name}' is not a view") from None
+        return self.cursor.execute(sql)
 
     def __get_columns(self, table_name):
         """return a list of columns for the given table"""
-        sql = """PRAGMA table_info("{}")"""
-        sql = sql.format(table_name)
+        try:
+            return self.__columns[table_name]
+        except KeyError:
+            # the columns have not been retrieved from the database yet.
+            pass
+
+        sql = f"PRAGMA table_info({self.__quote(table_name)})"
         results = self.cursor.execute(sql)
-        cols = [col[1] for col in results]
-        return cols
+        self.__columns[table_name] = [col[1] for col in results]
+        return self.__columns[table_name]
 
     def __get_title(self, view_names):
         """return the name/title to be used as the page title"""
-        map_names = self.layout["titles"]
-        titles = []
         if isinstance(view_names, list):
-            for view in view_names:
-                titles.append(map_names.get(view, view))
-        else:
-            titles = map_names.get(view_names, view_names)
-        return titles
+            return [self.__titles.get(view, view) for view in view_names]
+        return self.__titles.get(view_names, view_names)
+
+    def __get_common_context(self):
+        """return the variables that are the same for every report"""
+        return dict(
+            categories=self.__category_links,
+            updated=datetime.now().isoformat(timespec="seconds"),
+            css_styles=self.paths["css_styles"],
+            javascripts=self.paths["javascript"],
+        )
 
-    def __render_report(self, view_name, data, parse=False):
-        """render an output report"""
+    def __get_context(self, view_name, common, parse=False):
+        """return the variables used to render the report for the view"""
         # Set up basic constants for this report
-        update = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
-        css_styles = self.paths["css_styles"]
-        js = self.paths["javascript"]
         headers = self.__get_columns(view_name)
         caption = self.layout["captions"].get(view_name, "")
         title = self.__get_title(view_name)
         description = self.layout["descriptions"].get(view_name, "")
-        categories = self.__get_category_links(self.categories)
 
-        # Query database for all rows for view given by input
+        # Query database for all rows for view given by input. The columns
+        # must be queried first, since the rows are read lazily from the
+        # cursor while rendering.
+        rows = self.__get_rows(view_name)
         if parse:  # pragma: no cover
-            # call the parse function that may be overloaded
-            data = self.parse(data)
-        rows = data.get(view_name, [])
+            # call the parse function that may be overloaded. The parse
+            # function expects all the data, so the rows are fetched here.
+            data = self.parse({view_name: rows.fetchall()})
+            rows = data.get(view_name, [])
 
-        # Get the template for reports and render
-        temp = self.env.get_template(os.path.basename(self.paths["template"]))
-        html = temp.render(
+        return dict(
+            common,
             title=title,
             description=description,
-            categories=categories,
-            updated=update,
             caption=caption,
-            css_styles=css_styles,
-            javascripts=js,
             headers=headers,
             rows=rows,
         )
 
-        return html
+    def __render_report(self, view_name, common, parse=False):
+        """render an output report"""
+        context = self.__get_context(view_name, common, parse)
+        return self.__template.render(**context)
+
+    def __write_report(self, view_name, report_dir, common, parse=False):
+        """write an output report to its file in the report directory"""
+        # the report is streamed to a temporary file that only replaces the
+        # report once it is complete, so a failed render never leaves a
+        # truncated report behind
+        context = self.__get_context(view_name, common, parse)
+        filename = os.path.join(report_dir, f"{view_name}.html")
+        temp_filename = f"{filename}.tmp"
+        try:
+            with open(temp_filename, "w") as f:
+                self.__template.stream(**context).dump(f)
+            os.replace(temp_filename, filename)
+        finally:
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+
+    def __prepare_views(self, views):
+        """
+        Return the views given to `render` or `write` as a list
+
+        Every view is checked before any report is rendered or written, and
+        their columns are looked up so they are cached.
+
+        Raises a :obj:`ValueError` when a view is not in the database.
+        """
+        if isinstance(views, str):
+            # views is a single view name and not a list.
+            # convert it to a list
+            views = [views]
+        elif views is None:
+            # since no views where explicitly given, render all views
+            views = self.views
+
+        # remove any duplicates, so each report is only rendered once
+        views = list(dict.fromkeys(views))
+        for view in views:
+            if view not in self.__queries:
+                raise ValueError(f"'{view}' is not a view")
+        for view in views:
+            self.__get_columns(view)
+        return views
 
     def render(self, views=None, parse=False):
         """
@@ -418,41 +586,43 @@ class Report:
         Returns:
             :obj:`dict`: Rendered html of reports
 
+        Raises:
+            :obj:`ValueError`: When a view is not in the database
+
         .. versionchanged:: 0.3.3a1
             returns results; :obj:`parse` default was :obj:`True`
         """
-        if isinstance(views, str):
-            # views is a single view name and not a list.
-            # convert it to a list
-            views = [views]
-        elif views is None:
-            # since no views where explicitly given, render all views
-            views = self.views
+        views = self.__prepare_views(views)
+        common = self.__get_common_context()
 
         reports = {}
         for view in views:
-            data = self.__get_data(view)
-            html = self.__render_report(view, data, parse)
+            html = self.__render_report(view, common, parse)
             reports.setdefault(view, html)
         return reports
 
-    def write(self, report_dir=None, **kwargs):
+    def write(self, report_dir=None, views=None, parse=False):
         """
         Write rendered reports to files
 
+        The reports are streamed to the files as they are rendered, so the
+        full html of a report is never held in memory.
+
         Parameters:
             report_dir (:obj:`str` | :obj:`None`)
                 path where reports are written to defaults to :obj:`None`,
                  which will use the path in the layout.
-            kwargs (:obj:`dict`)
-                all other keyword arguments are passed directly to the render
-                function.
+            views (:obj:`list` | :obj:`None`): list of view names to write,
+                defaults to :obj:`None`, all views
+            parse (:obj:`bool`): whether the parse function is called on
+                query results. Defaults to :obj:`False` (don't parse)
 
         Returns:
             :obj:`None`: No return value
 
         Raises:
             :obj:`NotADirectoryError`: When report path does not exist
+            :obj:`ValueError`: When a view is not in the database
 
         .. versionadded:: 0.3.3a1
         """
@@ -463,11 +633,11 @@ class Report:
         if not os.path.isdir(report_dir):
             raise NotADirectoryError(f"{report_dir} is not a directory")
 
-        rendered_reports = self.render(**kwargs)
-        for view, html in rendered_reports.items():
-            filename = os.path.join(report_dir, f"{view}.html")
-            with open(filename, "w") as f:
-                f.write(html)
+        views = self.__prepare_views(views)
+        common = self.__get_common_context()
+
+        for view in views:
+            self.__write_report(view, report_dir, common, parse)
 
     def parse(self, data):
         """
@@ -132,3 +132,28 @@ def report_from_layout(db_connection):
     report = Report(path)
     yield report, layout
     os.remove(path)
+
+
+@pytest.fixture()
+def indexed_database(tmp_path):
+    """
+    create a small database with an indexed table and a view on it
+
+    The database has no query planner statistics (no sqlite_stat1 table).
+    """
+    path = str(tmp_path / "indexed.db")
+    conn = sq3.connect(path)
+    conn.executescript(
+        """
+        CREATE TABLE items (id INTEGER PRIMARY KEY, name TEXT, size INTEGER);
+        CREATE INDEX items_size ON items (size);
+        CREATE VIEW largeItems AS SELECT name FROM items WHERE size > 10;
+        """
+    )
+    conn.executemany(
+        "INSERT INTO items (name, size) VALUES (?, ?)",
+        [(f"item {i}", i % 20) for i in range(100)],
+    )
+    conn.commit()
+    conn.close()
+    yield path
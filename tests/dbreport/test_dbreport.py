@@ -1,8 +1,10 @@
 import os
+import sqlite3 as sq3
 
 import pytest
 
 from dbreport.dbreport import Report
+from tests.data.db_setup import TEST_PATH
 
 
 def test_all_views_are_rendered(rendered_reports, views):
@@ -167,3 +169,117 @@ def test_layout_ignore_views(report_from_layout):
     assert (
             ignore_view not in reports.keys()
     ), f"ignored view '{ignore_view}' was still rendered"
+
+
+def test_default_pragmas(report):
+    cache_size = report.cursor.execute("PRAGMA cache_size").fetchone()[0]
+    assert cache_size == -8192, "default cache_size pragma was not set"
+
+
+def test_pragma_set_to_none_is_skipped(db_connection):
+    report = Report(
+        paths={"database": TEST_PATH}, pragmas={"cache_size": None}
+    )
+    cache_size = report.cursor.execute("PRAGMA cache_size").fetchone()[0]
+    assert cache_size != -8192, "pragma set to None should not be set"
+
+
+def test_materialize_views(db_connection, views, patch_datetime):
+    report = Report(paths={"database": TEST_PATH}, materialize_views=True)
+    sql = "SELECT name FROM cache.sqlite_master WHERE type = 'table'"
+    tables = [row[0] for row in report.cursor.execute(sql)]
+    assert sorted(tables) == sorted(views), "views were not materialized"
+    assert report.render() == Report(paths={"database": TEST_PATH}).render()
+
+
+def test_materialize_views_skips_small_database(db_connection, monkeypatch):
+    monkeypatch.setattr("dbreport.dbreport.MATERIALIZE_MIN_PAGES", 10 ** 9)
+    report = Report(paths={"database": TEST_PATH}, materialize_views=True)
+    cursor = report.cursor.execute("PRAGMA database_list")
+    databases = [row[1] for row in cursor]
+    assert "cache" not in databases, "small database should not be copied"
+
+
+def test_render_view_that_does_not_exist(report):
+    with pytest.raises(ValueError):
+        report.render(views=['"; DROP TABLE albums; --'])
+
+
+def test_write_subset_of_views(report, views):
+    report.write(".", views=views[0])
+    try:
+        assert os.path.isfile(f"{views[0]}.html"), "report was not written"
+        for view in views[1:]:
+            assert not os.path.isfile(f"{view}.html"), "extra report written"
+    finally:
+        os.remove(f"{views[0]}.html")
+
+
+def test_write_view_that_does_not_exist(report, views, tmp_path):
+    report_dir = tmp_path / "reports"
+    report_dir.mkdir()
+    keep = tmp_path / "keep.html"
+    keep.write_text("keep")
+    with pytest.raises(ValueError):
+        report.write(str(report_dir), views=["../keep", views[0]])
+    assert keep.read_text() == "keep", "file outside report dir was changed"
+    assert list(report_dir.iterdir()) == [], "report written for bad views"
+
+
+def has_stats(database):
+    conn = sq3.connect(database)
+    sql = "SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'"
+    stats = conn.execute(sql).fetchone() is not None
+    conn.close()
+    return stats
+
+
+def test_optimize_on_connect(indexed_database):
+    Report(paths={"database": indexed_database}, optimize_on_connect=True)
+    assert has_stats(indexed_database), "planner statistics were not gathered"
+
+
+def test_optimize_on_connect_default_off(indexed_database):
+    Report(paths={"database": indexed_database}).render()
+    assert not has_stats(indexed_database), "database should not be changed"
+
+
+def test_pragma_from_layout_is_applied(db_connection):
+    report = Report(paths={"database": TEST_PATH}, pragmas={"mmap_size": 4096})
+    mmap_size = report.cursor.execute("PRAGMA mmap_size").fetchone()[0]
+    assert mmap_size == 4096, "pragma from layout was not set"
+
+
+def test_invalid_pragma_name(db_connection):
+    with pytest.raises(ValueError):
+        Report(
+            paths={"database": TEST_PATH},
+            pragmas={"cache_size = 0; DROP TABLE albums; --": 1},
+        )
+
+
+def test_invalid_pragma_value(db_connection):
+    with pytest.raises(ValueError):
+        Report(
+            paths={"database": TEST_PATH},
+            pragmas={"cache_size": "0; DROP TABLE albums"},
+        )
+
+
+def test_materialize_views_with_broken_view(indexed_database, monkeypatch):
+    conn = sq3.connect(indexed_database)
+    conn.executescript(
+        """
+        CREATE TABLE dropped (id INTEGER);
+        CREATE VIEW brokenView AS SELECT id FROM dropped;
+        DROP TABLE dropped;
+        """
+    )
+    conn.close()
+    monkeypatch.setattr("dbreport.dbreport.MATERIALIZE_MIN_PAGES", 0)
+    report = Report(
+        paths={"database": indexed_database}, materialize_views=True
+    )
+    assert "largeItems" in report.render(views="largeItems")
+    with pytest.raises(sq3.OperationalError):
+        report.render(views="brokenView")
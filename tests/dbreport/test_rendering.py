@@ -98,3 +98,11 @@ def test_titles(db_connection, views):
         soup = BeautifulSoup(html, features="html.parser")
         title = soup.find("title")
         assert title.text == view.upper(), "title does match expected value"
+
+
+def test_category_links(report, views):
+    report.categories = {"Some Category": views[0:2]}
+    rendered = report.render(views=views[0])
+    soup = BeautifulSoup(rendered[views[0]], features="html.parser")
+    links = [a["href"] for a in soup.find("div", id="navbar").find_all("a")]
+    assert links == [f"./{view}.html" for view in views[0:2]]